@@ -6,16 +6,34 @@
     Authenticate users in your Flask app with GitHub.
 
 """
+import base64
+import datetime
+import hashlib
+import io
 import logging
+import os
+import re
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
 try:
-    from urllib.parse import urlencode, parse_qs
+    from urllib.parse import urlencode, parse_qs, urlsplit
 except ImportError:
     from urllib import urlencode
-    from urlparse import parse_qs
+    from urlparse import parse_qs, urlsplit
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from collections import deque, OrderedDict
+from contextlib import closing, contextmanager
+from fnmatch import fnmatchcase
 from functools import wraps
 
-import requests
-from flask import redirect, request, json
+from flask import redirect, request, json, g, has_app_context, \
+    has_request_context
 
 __version__ = '3.2.0'
 
@@ -24,6 +42,9 @@ _logger = logging.getLogger(__name__)
 null_handler = logging.NullHandler()
 _logger.addHandler(null_handler)
 
+# Monotonic clock where available, falls back to wall clock on Python 2.
+_now = getattr(time, 'monotonic', time.time)
+
 
 def is_valid_response(response):
     """Returns ``True`` if response ``status_code`` is not an error type,
@@ -50,6 +71,180 @@ def is_json_response(response):
     return content_type == 'application/json' or content_type.startswith('application/json;')
 
 
+def is_secondary_rate_limit(response):
+    """Returns ``True`` if ``response`` was rejected by GitHub's secondary
+    rate limit (or a 429), meaning the request was not applied and can be
+    retried safely.
+
+    :param response: :class:~`requests.Response` object to check
+    :type response: :class:~`requests.Response`
+    :rtype bool:
+    """
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    if 'Retry-After' in response.headers:
+        return True
+    try:
+        message = response.json()['message']
+    except Exception:
+        return False
+    return 'secondary rate limit' in message.lower()
+
+
+def _is_rate_limited(response):
+    """Returns ``True`` if ``response`` was rejected by the primary or the
+    secondary rate limit."""
+    return is_secondary_rate_limit(response) or (
+        response.status_code == 403 and
+        response.headers.get('X-RateLimit-Remaining') == '0')
+
+
+def _hash_token(authorization):
+    """Returns a key identifying the token of an ``Authorization`` header
+    without keeping the token itself."""
+    return hashlib.sha1(authorization.encode('utf-8')).hexdigest()
+
+
+def _get_retry_delay(response, default):
+    """Returns the number of seconds to wait before retrying ``response``."""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        pass
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        try:
+            return max(float(response.headers['X-RateLimit-Reset']) -
+                       time.time(), 0)
+        except (KeyError, ValueError):
+            pass
+    return default
+
+
+class _Throttle(object):
+    """Spaces calls to :meth:`wait` at least ``interval`` seconds apart
+    across threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = _now()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def delay(self, seconds):
+        """Holds back every waiter for at least ``seconds`` from now."""
+        with self._lock:
+            self._next = max(self._next, _now() + seconds)
+
+
+def _call_throttled(throttle, max_retries, backoff, func, *args, **kwargs):
+    """Calls ``func`` once ``throttle`` allows it and retries up to
+    ``max_retries`` times while GitHub rejects it for rate limiting. A
+    rejection holds back every caller sharing ``throttle``."""
+    for attempt in range(max_retries + 1):
+        throttle.wait()
+        try:
+            return func(*args, **kwargs)
+        except GitHubError as e:
+            if attempt == max_retries or e.response is None or \
+                    not _is_rate_limited(e.response):
+                raise
+            delay = _get_retry_delay(e.response, backoff * 2 ** attempt)
+            _logger.info("Rate limit hit, waiting %.1fs", delay)
+            throttle.delay(delay)
+
+
+_DONE = object()
+
+
+def _imap_unordered(func, iterable, max_workers):
+    """Calls ``func`` for every item of ``iterable`` from up to
+    ``max_workers`` threads and yields ``(item, result, error)`` tuples in
+    completion order. ``iterable`` is consumed lazily and workers wait while
+    results are not consumed. Closing the generator stops the workers from
+    taking new items; calls already running are finished."""
+    items = iter(iterable)
+    lock = threading.Lock()
+    stop = threading.Event()
+    results = queue.Queue(maxsize=max(1, max_workers))
+    errors = []
+
+    def put(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    if stop.is_set():
+                        return
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    except Exception as e:
+                        errors.append(e)
+                        return
+                try:
+                    put((item, func(item), None))
+                except Exception as e:
+                    put((item, None, e))
+        finally:
+            put(_DONE)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, max_workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = len(threads)
+    try:
+        while running:
+            result = results.get()
+            if result is _DONE:
+                running -= 1
+            else:
+                yield result
+    finally:
+        stop.set()
+    if errors:
+        raise errors[0]
+
+
+class BulkResult(object):
+    """Outcome of a single operation passed to :meth:`GitHub.bulk`."""
+
+    def __init__(self, operation, result=None, error=None):
+        #: The ``(method, resource[, data])`` tuple as given.
+        self.operation = operation
+        #: Return value of :meth:`GitHub.request` if it succeeded.
+        self.result = result
+        #: The exception raised by the operation, if any.
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<BulkResult %s %s %s>' % (
+            self.operation[0], self.operation[1],
+            'ok' if self.ok else self.error)
+
+
 class GitHubError(Exception):
     """Raised if a request fails to the GitHub API."""
 
@@ -66,6 +261,970 @@ class GitHubError(Exception):
         return self.args[0]
 
 
+class GitHubCircuitOpenError(GitHubError):
+    """Raised without making a request while the circuit breaker for the
+    endpoint is open. :attr:`response` is always ``None``."""
+
+    def __init__(self, key, retry_after):
+        super(GitHubCircuitOpenError, self).__init__(None, key, retry_after)
+
+    def __str__(self):
+        return "circuit open for %s, retry in %.1fs" % (self.key,
+                                                        self.retry_after)
+
+    @property
+    def key(self):
+        """The endpoint class whose circuit is open."""
+        return self.args[1]
+
+    @property
+    def retry_after(self):
+        """Seconds until the circuit lets a probe request through."""
+        return self.args[2]
+
+
+class GitHubDeadlineExceeded(GitHubError):
+    """Raised without making a request when the time budget set with
+    :meth:`GitHub.deadline` or ``GITHUB_REQUEST_DEADLINE`` is used up.
+    :attr:`response` is always ``None``."""
+
+    def __init__(self):
+        super(GitHubDeadlineExceeded, self).__init__(None)
+
+    def __str__(self):
+        return "deadline exceeded"
+
+
+class _Deadline(object):
+    """Context manager and decorator returned by :meth:`GitHub.deadline`."""
+
+    def __init__(self, github, seconds):
+        self.github = github
+        self.seconds = seconds
+
+    def __enter__(self):
+        stack = self.github._get_local_stack('deadlines')
+        deadline = _now() + self.seconds
+        if stack:
+            deadline = min(deadline, stack[-1])
+        stack.append(deadline)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.github._get_local_stack('deadlines').pop()
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with _Deadline(self.github, self.seconds):
+                return f(*args, **kwargs)
+        return decorated
+
+
+class _Lane(object):
+    """Context manager and decorator returned by :meth:`GitHub.lane`."""
+
+    def __init__(self, github, name):
+        self.github = github
+        self.name = name
+
+    def __enter__(self):
+        self.github._get_local_stack('lanes').append(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.github._get_local_stack('lanes').pop()
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with self:
+                return f(*args, **kwargs)
+        return decorated
+
+
+def _cap_timeout(timeout, remaining):
+    """Limits ``timeout`` (a number, a ``(connect, read)`` tuple or
+    ``None``) to ``remaining`` seconds."""
+    if isinstance(timeout, tuple):
+        return tuple(_cap_timeout(t, remaining) for t in timeout)
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+class _LatencyTracker(object):
+    """Keeps a sliding window of observed latencies per endpoint class."""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, elapsed):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(elapsed)
+
+    def percentile(self, key, p, min_samples=20):
+        """Returns the ``p`` percentile (0-100) of latencies for ``key`` or
+        ``None`` if fewer than ``min_samples`` were observed."""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if not samples or len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+        return samples[index]
+
+
+class PriorityScheduler(object):
+    """
+    Admits requests from named lanes. ``lanes`` maps lane names to dicts
+    with:
+
+    ``priority``
+        Lower values are served first. A queued request only waits behind
+        requests of lanes with a lower or equal priority value.
+    ``concurrency``
+        Maximum number of requests of the lane in flight at once.
+    ``quota``
+        Fraction of a token's rate limit the lane may use up. For example
+        with ``0.5`` the lane waits for the rate limit of the token to reset
+        once less than half of it is left, saving the rest for other lanes.
+        Lanes with a quota of ``1.0`` or more never wait for the rate limit;
+        their requests are sent and rejected by GitHub when it is used up.
+
+    Rate limits apply per access token, so they are tracked for the
+    ``token`` passed to :meth:`acquire` and :meth:`release`.
+
+    At most ``max_concurrency`` requests of all lanes are in flight.
+
+    """
+
+    def __init__(self, lanes, max_concurrency=10):
+        for name, lane in lanes.items():
+            missing = set(('priority', 'concurrency', 'quota')) - set(lane)
+            if missing:
+                raise ValueError("lane %r misses %s" %
+                                 (name, ', '.join(sorted(missing))))
+        self.lanes = lanes
+        self.max_concurrency = max_concurrency
+        self._running = dict((name, 0) for name in lanes)
+        self._stats = dict((name, {'requests': 0, 'wait_time': 0.0,
+                                   'max_wait': 0.0}) for name in lanes)
+        self._queue = []
+        self._sequence = 0
+        self._rate_limits = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, lane, timeout=None, token=None):
+        """Waits until a request of ``lane`` made with ``token`` (any key
+        identifying the access token) may be sent. Returns ``False`` if
+        that did not happen within ``timeout`` seconds."""
+        if lane not in self.lanes:
+            raise ValueError("unknown lane %r" % lane)
+        start = _now()
+        with self._cond:
+            self._sequence += 1
+            ticket = (self.lanes[lane]['priority'], self._sequence, lane,
+                      token)
+            self._queue.append(ticket)
+            try:
+                while not self._can_run(ticket):
+                    wait = None if timeout is None else \
+                        timeout - (_now() - start)
+                    if wait is not None and wait <= 0:
+                        return False
+                    # Wake up periodically to notice a rate limit reset.
+                    self._cond.wait(1.0 if wait is None else min(wait, 1.0))
+            finally:
+                self._queue.remove(ticket)
+            self._running[lane] += 1
+            waited = _now() - start
+            stats = self._stats[lane]
+            stats['requests'] += 1
+            stats['wait_time'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+        return True
+
+    def release(self, lane, response=None, token=None):
+        """Marks a request of ``lane`` as finished. Rate limit headers of
+        ``response`` are used to enforce the quotas of ``token``."""
+        with self._cond:
+            self._running[lane] -= 1
+            if response is not None:
+                self._update_rate_limit(token, response)
+            self._cond.notify_all()
+
+    def stats(self):
+        """Returns ``queued``, ``running``, ``requests``, ``wait_time`` and
+        ``max_wait`` (in seconds) of every lane."""
+        with self._cond:
+            result = {}
+            for name, stats in self._stats.items():
+                stats = dict(stats)
+                stats['queued'] = sum(1 for ticket in self._queue
+                                      if ticket[2] == name)
+                stats['running'] = self._running[name]
+                result[name] = stats
+            return result
+
+    def _can_run(self, ticket):
+        if sum(self._running.values()) >= self.max_concurrency:
+            return False
+        if not self._is_admissible(ticket[2], ticket[3]):
+            return False
+        # Requests queued before, or with a higher priority, go first.
+        return not any(other < ticket and
+                       self._is_admissible(other[2], other[3])
+                       for other in self._queue)
+
+    def _is_admissible(self, lane, token):
+        if self._running[lane] >= self.lanes[lane]['concurrency']:
+            return False
+        quota = self.lanes[lane]['quota']
+        rate_limit = self._rate_limits.get(token)
+        if quota >= 1.0 or rate_limit is None:
+            return True
+        limit, remaining, reset = rate_limit
+        if reset <= time.time():
+            del self._rate_limits[token]
+            return True
+        return limit - remaining < limit * quota
+
+    def _update_rate_limit(self, token, response):
+        headers = response.headers
+        if headers.get('X-RateLimit-Resource', 'core') != 'core':
+            return
+        try:
+            self._rate_limits[token] = (int(headers['X-RateLimit-Limit']),
+                                        int(headers['X-RateLimit-Remaining']),
+                                        float(headers['X-RateLimit-Reset']))
+        except (KeyError, ValueError):
+            return
+        if len(self._rate_limits) > 1000:
+            now = time.time()
+            for key, (_, _, reset) in list(self._rate_limits.items()):
+                if reset <= now:
+                    del self._rate_limits[key]
+
+
+#: Lanes used by :class:`PriorityScheduler` unless overridden by the
+#: ``GITHUB_PRIORITY_LANES`` setting.
+DEFAULT_LANES = {
+    'interactive': {'priority': 0, 'concurrency': 10, 'quota': 1.0},
+    'background': {'priority': 1, 'concurrency': 4, 'quota': 0.8},
+    'bulk': {'priority': 2, 'concurrency': 2, 'quota': 0.5},
+}
+
+
+class CircuitBreaker(object):
+    """
+    Tracks failures per endpoint class. After ``failure_threshold``
+    consecutive failures the circuit opens and requests fail fast with
+    :class:`GitHubCircuitOpenError`. After ``reset_timeout`` seconds a single
+    probe request is let through (half-open); its outcome closes or re-opens
+    the circuit. Responses slower than ``latency_threshold`` seconds count as
+    failures.
+
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 latency_threshold=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_threshold = latency_threshold
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def state(self, key):
+        """Returns the state of the circuit for ``key``."""
+        with self._lock:
+            return self._circuits.get(key, {}).get('state', self.CLOSED)
+
+    def before_request(self, key):
+        """Raises :class:`GitHubCircuitOpenError` if the circuit for ``key``
+        does not allow a request to be made now."""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            if circuit is None or circuit['state'] == self.CLOSED:
+                return
+            retry_after = circuit['opened_at'] + self.reset_timeout - _now()
+            if circuit['state'] == self.OPEN and retry_after <= 0:
+                _logger.debug("Circuit half-open for %s", key)
+                circuit['state'] = self.HALF_OPEN
+                return
+            raise GitHubCircuitOpenError(key, max(retry_after, 0))
+
+    def record_success(self, key, elapsed):
+        if self.latency_threshold is not None and \
+                elapsed > self.latency_threshold:
+            self.record_failure(key)
+            return
+        with self._lock:
+            self._circuits.pop(key, None)
+
+    def record_failure(self, key):
+        with self._lock:
+            circuit = self._circuits.setdefault(
+                key, {'state': self.CLOSED, 'failures': 0, 'opened_at': 0})
+            circuit['failures'] += 1
+            if circuit['state'] == self.HALF_OPEN or \
+                    circuit['failures'] >= self.failure_threshold:
+                if circuit['state'] != self.OPEN:
+                    _logger.warning("Circuit opened for %s", key)
+                circuit['state'] = self.OPEN
+                circuit['opened_at'] = _now()
+
+
+#: Response headers stored in cassettes by :class:`RecordingTransport`.
+CASSETTE_HEADERS = ('Content-Type', 'Link', 'ETag', 'Last-Modified',
+                    'Location', 'Retry-After', 'X-RateLimit-Limit',
+                    'X-RateLimit-Remaining', 'X-RateLimit-Reset',
+                    'X-RateLimit-Used', 'X-RateLimit-Resource')
+
+
+class RecordingTransport(object):
+    """
+    A :mod:`requests` transport adapter that sends requests through
+    ``adapter`` (a new :class:`~requests.adapters.HTTPAdapter` by default)
+    and appends every request/response pair to the cassette file at
+    ``path``, one JSON object per line. Only the method, URL, status, the
+    headers in :data:`CASSETTE_HEADERS` and the body are stored; request
+    headers (and so the ``Authorization`` header) are not.
+
+    Note that recorded response bodies, for example the one of the OAuth
+    access token request, may contain secrets.
+
+    """
+
+    def __init__(self, path, adapter=None):
+        if adapter is None:
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter()
+        self.path = path
+        self.adapter = adapter
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        content = response.content
+        # The body has been read, give streaming readers a fresh copy.
+        response.raw = io.BytesIO(content)
+        record = {
+            'method': request.method,
+            'url': request.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict((name, response.headers[name])
+                            for name in CASSETTE_HEADERS
+                            if name in response.headers),
+        }
+        try:
+            record['text'] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            record['base64'] = base64.b64encode(content).decode('ascii')
+        line = json.dumps(record, separators=(',', ':'))
+        with self._lock:
+            with io.open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + u'\n')
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayTransport(object):
+    """
+    A :mod:`requests` transport adapter that serves responses from a
+    cassette written by :class:`RecordingTransport` without touching the
+    network. Requests are matched by method and URL; if a pair was recorded
+    several times the responses are served in order and then start over.
+    Each response is delayed by ``latency`` seconds to simulate the network.
+    Unknown requests raise :class:`requests.ConnectionError`.
+
+    """
+
+    def __init__(self, path, latency=0):
+        self.path = path
+        self.latency = latency
+        self._records = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    key = (record['method'], record['url'])
+                    self._records.setdefault(key, []).append(record)
+
+    def send(self, request, **kwargs):
+        import requests
+        from datetime import timedelta
+        from requests.structures import CaseInsensitiveDict
+        from requests.utils import get_encoding_from_headers
+
+        key = (request.method, request.url)
+        with self._lock:
+            records = self._records.get(key)
+            if not records:
+                raise requests.ConnectionError(
+                    "No recorded response for %s %s" % key, request=request)
+            position = self._positions.get(key, 0)
+            self._positions[key] = (position + 1) % len(records)
+        record = records[position]
+        if self.latency:
+            time.sleep(self.latency)
+        if 'base64' in record:
+            content = base64.b64decode(record['base64'])
+        else:
+            content = record['text'].encode('utf-8')
+        response = requests.Response()
+        response.status_code = record['status']
+        response.reason = record.get('reason')
+        response.headers = CaseInsensitiveDict(record['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = content
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = timedelta(seconds=self.latency)
+        return response
+
+    def close(self):
+        pass
+
+
+_GIT_OBJECT_PATH = re.compile(
+    r'/repos/[^/]+/[^/]+/(git/blobs|git/trees|git/commits|git/tags|commits)/'
+    r'([0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+class GitObjectCache(object):
+    """
+    Cache for API resources addressed by a full git object SHA (blobs,
+    trees, commits and tags), which can never change. Entries never expire
+    by age; the least recently used ones are evicted once the cached bodies
+    exceed ``max_bytes``. If ``path`` is given, entries are also written to
+    that directory and read back from it after eviction or a restart; the
+    directory is not size limited.
+
+    Entries are scoped to the access token that fetched them, since
+    GitHub must check that token's permissions. Within a token, blobs are
+    cached by SHA alone, so a blob shared by several repositories is
+    fetched and stored once.
+
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the cached body for ``key`` or ``None``."""
+        with self._lock:
+            content = self._entries.pop(key, None)
+            if content is not None:
+                self._entries[key] = content
+                return content
+        if self.path is None:
+            return None
+        try:
+            with open(self._get_file_path(key), 'rb') as f:
+                content = f.read()
+        except (IOError, OSError):
+            return None
+        self._store(key, content)
+        return content
+
+    def set(self, key, content):
+        """Caches ``content`` (bytes) for ``key``."""
+        self._store(key, content)
+        if self.path is not None:
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            getattr(os, 'replace', os.rename)(tmp, self._get_file_path(key))
+
+    def _store(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def _get_file_path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, name)
+
+
+class Outbox(object):
+    """
+    Durable queue of write requests stored in the SQLite database at
+    ``path``. Adding a request only writes it to the database; a drainer
+    sends it later through :meth:`GitHub.request`, either by calling
+    :meth:`drain` or from the background thread started with :meth:`start`.
+
+    Requests for the same resource are sent in the order they were added,
+    also when several processes drain the same database: each drainer claims
+    the requests it sends in a single transaction and renews the claim of
+    each request right before sending it. A claim older than
+    ``claim_timeout`` seconds is assumed to belong to a crashed drainer and
+    the request is taken over. ``claim_timeout`` must therefore be longer
+    than a single request can take, or a slow request may be sent twice.
+
+    Requests rejected without being applied (rate limits, an open circuit,
+    a connection that could not be established) are retried with
+    exponential backoff, up to ``max_attempts`` times. Other connection
+    errors, timeouts and 5xx responses may come after GitHub applied the
+    request, so they are only retried for ``PUT`` and ``DELETE`` requests,
+    which can be repeated safely. All other errors mark the request as
+    failed.
+
+    Every request has an idempotency key. Adding a request with a key that
+    is already in the outbox does nothing, so the same write intent is never
+    queued twice. The access token is stored with each request until it is
+    done or has failed. Finished requests are kept for deduplication until
+    they are removed with :meth:`purge`.
+
+    .. code-block:: python
+
+        outbox = Outbox(github, '/var/lib/myapp/outbox.db')
+        outbox.start()
+
+        @app.route('/approve/<int:number>', methods=['POST'])
+        def approve(number):
+            outbox.post('repos/o/r/issues/%d/labels' % number, ['approved'],
+                        key='approve-%d' % number)
+            return ''
+
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, github, path, max_attempts=10, backoff=2.0,
+                 max_backoff=300.0, claim_timeout=300.0):
+        self.github = github
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.claim_timeout = claim_timeout
+        self._drain_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        with self._connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS outbox ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'key TEXT NOT NULL UNIQUE, '
+                'method TEXT NOT NULL, '
+                'resource TEXT NOT NULL, '
+                'data TEXT, '
+                'access_token TEXT, '
+                'status TEXT NOT NULL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'next_attempt REAL NOT NULL DEFAULT 0, '
+                'claimed_at REAL, '
+                'claim_id TEXT, '
+                'finished_at REAL, '
+                'error TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS outbox_status '
+                       'ON outbox (status, id)')
+
+    @contextmanager
+    def _connect(self):
+        """Opens the database in a transaction that holds the write lock,
+        so concurrent drainers see each other's claims."""
+        import sqlite3
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def add(self, method, resource, data=None, key=None, access_token=None):
+        """
+        Queues a request and returns its idempotency key. ``data`` is JSON
+        encoded like in :meth:`GitHub.post`; with ``None`` no body is sent.
+        If ``access_token`` is not given the :meth:`GitHub.access_token_getter`
+        is called now, while the Flask request is still active.
+
+        """
+        if key is None:
+            key = uuid.uuid4().hex
+        if access_token is None:
+            access_token = self.github.get_access_token()
+        if data is not None:
+            data = json.dumps(data)
+        with self._connect() as db:
+            db.execute('INSERT OR IGNORE INTO outbox (key, method, resource, '
+                       'data, access_token, status) VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, method, resource, data, access_token,
+                        self.PENDING))
+        return key
+
+    def post(self, resource, data=None, **kwargs):
+        return self.add('POST', resource, data, **kwargs)
+
+    def patch(self, resource, data=None, **kwargs):
+        return self.add('PATCH', resource, data, **kwargs)
+
+    def put(self, resource, data=None, **kwargs):
+        return self.add('PUT', resource, data, **kwargs)
+
+    def delete(self, resource, **kwargs):
+        return self.add('DELETE', resource, **kwargs)
+
+    def status(self, key):
+        """Returns ``(status, error)`` of the request with ``key`` or
+        ``None`` if there is no such request."""
+        with self._connect() as db:
+            return db.execute('SELECT status, error FROM outbox WHERE key = ?',
+                              (key,)).fetchone()
+
+    def pending(self):
+        """Returns the number of requests that were not sent yet."""
+        with self._connect() as db:
+            return db.execute('SELECT COUNT(*) FROM outbox WHERE status IN '
+                              '(?, ?)', (self.PENDING, self.SENDING)
+                              ).fetchone()[0]
+
+    def drain(self, limit=100):
+        """Sends up to ``limit`` of the oldest pending requests that are due
+        and returns how many were sent successfully or failed for good."""
+        with self._drain_lock:
+            claim_id = uuid.uuid4().hex
+            rows = self._claim(limit, claim_id)
+            blocked = set()
+            finished = 0
+            for row in rows:
+                id_, method, resource, data, token, attempts, due = row
+                if resource in blocked:
+                    # An earlier write to this resource is waiting for a
+                    # retry; give this one back without sending it.
+                    self._update(id_, claim_id, self.PENDING, attempts, due,
+                                 None)
+                    continue
+                if not self._renew_claim(id_, claim_id):
+                    # Taken over by another drainer after a stale claim.
+                    blocked.add(resource)
+                    continue
+                try:
+                    if data is None:
+                        self.github.request(method, resource,
+                                            access_token=token)
+                    else:
+                        self.github._request_json(method, resource,
+                                                  json.loads(data),
+                                                  access_token=token)
+                except Exception as e:
+                    attempts += 1
+                    if self._is_retryable(method, e) and \
+                            attempts < self.max_attempts:
+                        blocked.add(resource)
+                        delay = min(self.backoff * 2 ** (attempts - 1),
+                                    self.max_backoff)
+                        if getattr(e, 'response', None) is not None:
+                            delay = _get_retry_delay(e.response, delay)
+                        self._update(id_, claim_id, self.PENDING, attempts,
+                                     time.time() + delay, str(e))
+                    else:
+                        _logger.warning("Outbox request %s %s failed: %s",
+                                        method, resource, e)
+                        self._update(id_, claim_id, self.FAILED, attempts, 0,
+                                     str(e))
+                        finished += 1
+                else:
+                    self._update(id_, claim_id, self.DONE, attempts + 1, 0,
+                                 None)
+                    finished += 1
+            return finished
+
+    def _claim(self, limit, claim_id):
+        """Marks up to ``limit`` due requests as being sent by the drainer
+        identified by ``claim_id`` and returns them. Requests queued behind one that is not due, or
+        that another drainer is sending, are left alone."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute('UPDATE outbox SET status = ?, claim_id = NULL '
+                       'WHERE status = ? AND claimed_at < ?',
+                       (self.PENDING, self.SENDING, now - self.claim_timeout))
+            blocked = set(row[0] for row in db.execute(
+                'SELECT DISTINCT resource FROM outbox WHERE status = ?',
+                (self.SENDING,)))
+            claimed = []
+            for row in db.execute(
+                    'SELECT id, method, resource, data, access_token, '
+                    'attempts, next_attempt FROM outbox WHERE status = ? '
+                    'ORDER BY id LIMIT ?', (self.PENDING, limit)).fetchall():
+                resource, due = row[2], row[6]
+                if resource in blocked or due > now:
+                    blocked.add(resource)
+                else:
+                    claimed.append(row)
+            db.executemany('UPDATE outbox SET status = ?, claimed_at = ?, '
+                           'claim_id = ? WHERE id = ?',
+                           [(self.SENDING, now, claim_id, row[0])
+                            for row in claimed])
+        return claimed
+
+    def _renew_claim(self, id_, claim_id):
+        """Restarts the claim timeout of a request about to be sent. Returns
+        ``False`` if the drainer no longer owns the request."""
+        with self._connect() as db:
+            return db.execute('UPDATE outbox SET claimed_at = ? WHERE id = ? '
+                              'AND claim_id = ? AND status = ?',
+                              (time.time(), id_, claim_id, self.SENDING)
+                              ).rowcount == 1
+
+    def _update(self, id_, claim_id, status, attempts, next_attempt, error):
+        """Records the outcome of a request unless another drainer took it
+        over in the meantime. Finished requests forget their token."""
+        finished = status in (self.DONE, self.FAILED)
+        with self._connect() as db:
+            db.execute('UPDATE outbox SET status = ?, attempts = ?, '
+                       'next_attempt = ?, error = ?, claimed_at = NULL, '
+                       'claim_id = NULL, finished_at = ?, access_token = '
+                       'CASE WHEN ? THEN NULL ELSE access_token END '
+                       'WHERE id = ? AND claim_id = ? AND status = ?',
+                       (status, attempts, next_attempt, error,
+                        time.time() if finished else None, finished, id_,
+                        claim_id, self.SENDING))
+
+    def purge(self, older_than):
+        """Removes requests that were done or failed more than
+        ``older_than`` seconds ago and returns how many were removed. Their
+        idempotency keys can be added again afterwards."""
+        with self._connect() as db:
+            return db.execute('DELETE FROM outbox WHERE status IN (?, ?) '
+                              'AND finished_at < ?',
+                              (self.DONE, self.FAILED,
+                               time.time() - older_than)).rowcount
+
+    @staticmethod
+    def _is_retryable(method, error):
+        import requests
+        idempotent = method.upper() in ('PUT', 'DELETE')
+        if isinstance(error, GitHubError):
+            response = error.response
+            if response is None or _is_rate_limited(response):
+                # Not sent (open circuit, deadline) or rejected.
+                return True
+            return idempotent and response.status_code >= 500
+        if isinstance(error, requests.ConnectTimeout):
+            return True
+        return idempotent and isinstance(error, requests.RequestException)
+
+    def start(self, interval=1.0):
+        """Starts a daemon thread that drains the outbox, sleeping
+        ``interval`` seconds whenever there was nothing to send."""
+        self._stopped.clear()
+
+        def run():
+            while not self._stopped.is_set():
+                try:
+                    sent = self.drain()
+                except Exception:
+                    _logger.exception("Draining the outbox failed")
+                    sent = 0
+                if not sent:
+                    self._stopped.wait(interval)
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the thread started with :meth:`start`."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+_model_fields = {}
+
+
+class Model(object):
+    """
+    Base class for compact, typed API results. Only the fields listed in
+    ``__slots__`` of a subclass are kept; missing fields are ``None``.
+    Fields named in ``_nested`` are decoded into the given model (item by
+    item for lists). Pass ``model=`` to :meth:`GitHub.request` or any of the
+    verb methods to get instances instead of dictionaries.
+
+    """
+    __slots__ = ('_raw',)
+    _nested = {}
+
+    @classmethod
+    def _fields(cls):
+        try:
+            return _model_fields[cls]
+        except KeyError:
+            fields = _model_fields[cls] = tuple(
+                name for klass in reversed(cls.__mro__)
+                for name in getattr(klass, '__slots__', ())
+                if name != '_raw')
+            return fields
+
+    @classmethod
+    def from_dict(cls, data, keep_raw=False):
+        """Decodes ``data`` into an instance. With ``keep_raw`` the original
+        dictionary is kept as compact JSON and available as :attr:`raw`."""
+        obj = cls.__new__(cls)
+        nested = cls._nested
+        for name in cls._fields():
+            value = data.get(name)
+            if value is not None and name in nested:
+                if isinstance(value, list):
+                    value = [nested[name].from_dict(v) for v in value]
+                else:
+                    value = nested[name].from_dict(value)
+            setattr(obj, name, value)
+        if keep_raw:
+            obj._raw = json.dumps(data, separators=(',', ':'))
+        else:
+            obj._raw = None
+        return obj
+
+    @property
+    def raw(self):
+        """The original dictionary, decoded on access. ``None`` unless the
+        object was created with ``keep_raw``."""
+        if self._raw is None:
+            return None
+        return json.loads(self._raw)
+
+    def to_dict(self):
+        """Returns the declared fields as a dictionary."""
+        result = {}
+        for name in self._fields():
+            value = getattr(self, name)
+            if isinstance(value, Model):
+                value = value.to_dict()
+            elif isinstance(value, list):
+                value = [v.to_dict() if isinstance(v, Model) else v
+                         for v in value]
+            result[name] = value
+        return result
+
+    def __repr__(self):
+        field = self._fields()[0]
+        return '<%s %s=%r>' % (type(self).__name__, field,
+                               getattr(self, field))
+
+
+class User(Model):
+    __slots__ = ('login', 'id', 'type', 'name', 'email', 'html_url',
+                 'avatar_url', 'site_admin')
+
+
+class Label(Model):
+    __slots__ = ('name', 'id', 'color', 'description')
+
+
+class Repository(Model):
+    __slots__ = ('full_name', 'id', 'name', 'owner', 'private', 'fork',
+                 'archived', 'description', 'html_url', 'default_branch',
+                 'language', 'stargazers_count', 'forks_count',
+                 'open_issues_count', 'created_at', 'updated_at',
+                 'pushed_at')
+    _nested = {'owner': User}
+
+
+class Issue(Model):
+    __slots__ = ('number', 'id', 'title', 'state', 'user', 'labels',
+                 'assignees', 'comments', 'body', 'html_url', 'created_at',
+                 'updated_at', 'closed_at')
+    _nested = {'user': User, 'labels': Label, 'assignees': User}
+
+
+class PullRequestRef(Model):
+    __slots__ = ('label', 'ref', 'sha')
+
+
+class PullRequest(Model):
+    __slots__ = ('number', 'id', 'title', 'state', 'user', 'labels', 'body',
+                 'draft', 'merged', 'mergeable', 'head', 'base',
+                 'merge_commit_sha', 'html_url', 'created_at', 'updated_at',
+                 'closed_at', 'merged_at')
+    _nested = {'user': User, 'labels': Label, 'head': PullRequestRef,
+               'base': PullRequestRef}
+
+
+class GitActor(Model):
+    __slots__ = ('name', 'email', 'date')
+
+
+class GitCommit(Model):
+    __slots__ = ('message', 'author', 'committer')
+    _nested = {'author': GitActor, 'committer': GitActor}
+
+
+class Commit(Model):
+    __slots__ = ('sha', 'commit', 'author', 'committer', 'parents',
+                 'html_url')
+
+
+# Assigned after the class exists since parents are commits themselves.
+Commit._nested = {'commit': GitCommit, 'author': User, 'committer': User,
+                  'parents': Commit}
+
+
+def _decode_model(result, model, keep_raw=False):
+    if isinstance(result, list):
+        return [model.from_dict(item, keep_raw) for item in result]
+    if isinstance(result, dict) and isinstance(result.get('items'), list):
+        result['items'] = _decode_model(result['items'], model, keep_raw)
+        return result
+    return model.from_dict(result, keep_raw)
+
+
+_SEARCH_RESULT_LIMIT = 1000
+
+_DATE_QUALIFIERS = ('created', 'updated', 'pushed', 'closed', 'merged',
+                    'author-date', 'committer-date')
+
+
+def _split_range(low, high):
+    """Splits the inclusive range of dates or integers in two halves."""
+    if isinstance(low, datetime.date):
+        middle = low + datetime.timedelta(days=(high - low).days // 2)
+        return [(low, middle), (middle + datetime.timedelta(days=1), high)]
+    middle = (low + high) // 2
+    return [(low, middle), (middle + 1, high)]
+
+
 class GitHub(object):
     """
     Provides decorators for authenticating users with GitHub within a Flask
@@ -87,7 +1246,156 @@ class GitHub(object):
         self.client_secret = app.config['GITHUB_CLIENT_SECRET']
         self.base_url = app.config.get('GITHUB_BASE_URL', self.BASE_URL)
         self.auth_url = app.config.get('GITHUB_AUTH_URL', self.BASE_AUTH_URL)
-        self.session = requests.session()
+        self.timeout = app.config.get('GITHUB_TIMEOUT', 10.0)
+        self.adaptive_timeout = app.config.get('GITHUB_ADAPTIVE_TIMEOUT',
+                                               False)
+        self.min_timeout = app.config.get('GITHUB_MIN_TIMEOUT', 1.0)
+        self.latency = _LatencyTracker()
+        self.request_deadline = app.config.get('GITHUB_REQUEST_DEADLINE')
+        if self.request_deadline:
+            app.before_request(self._start_request_deadline)
+        self._local = threading.local()
+        lanes = app.config.get('GITHUB_PRIORITY_LANES')
+        if lanes:
+            merged = dict((name, dict(lane))
+                          for name, lane in DEFAULT_LANES.items())
+            if isinstance(lanes, dict):
+                for name, lane in lanes.items():
+                    # New lanes start from the background lane's settings.
+                    merged.setdefault(
+                        name, dict(DEFAULT_LANES['background'])).update(lane)
+            self.scheduler = PriorityScheduler(
+                merged, app.config.get('GITHUB_MAX_CONCURRENCY', 10))
+        else:
+            self.scheduler = None
+        self.hedge_requests = app.config.get('GITHUB_HEDGE_REQUESTS', False)
+        self.hedge_delay = app.config.get('GITHUB_HEDGE_DELAY', 1.0)
+        self.hedge_percentile = app.config.get('GITHUB_HEDGE_PERCENTILE', 95)
+        self.hedge_max_ratio = app.config.get('GITHUB_HEDGE_MAX_RATIO', 0.05)
+        #: Counters of hedged requests: ``requests`` eligible for hedging,
+        #: ``hedged`` requests that got a second attempt and ``hedge_wins``
+        #: where the second attempt answered first.
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+        self._hedge_lock = threading.Lock()
+        failure_threshold = app.config.get('GITHUB_CIRCUIT_FAILURE_THRESHOLD')
+        if failure_threshold:
+            self.circuit_breaker = CircuitBreaker(
+                failure_threshold,
+                app.config.get('GITHUB_CIRCUIT_RESET_TIMEOUT', 30.0),
+                app.config.get('GITHUB_CIRCUIT_LATENCY_THRESHOLD'))
+        else:
+            self.circuit_breaker = None
+        cache_size = app.config.get('GITHUB_GIT_OBJECT_CACHE_SIZE')
+        if cache_size:
+            self.git_object_cache = GitObjectCache(
+                cache_size, app.config.get('GITHUB_GIT_OBJECT_CACHE_DIR'))
+        else:
+            self.git_object_cache = None
+        self.record_to = app.config.get('GITHUB_RECORD_TO')
+        self.replay_from = app.config.get('GITHUB_REPLAY_FROM')
+        self.replay_latency = app.config.get('GITHUB_REPLAY_LATENCY', 0)
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The :class:`~requests.Session` used for all requests. It is
+        created on first use so that ``requests`` is only imported by
+        processes that actually talk to GitHub."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    def _create_session(self):
+        import requests
+        session = requests.session()
+        transport = None
+        if self.replay_from:
+            transport = ReplayTransport(self.replay_from, self.replay_latency)
+        elif self.record_to:
+            transport = RecordingTransport(self.record_to)
+        if transport is not None:
+            session.mount('https://', transport)
+            session.mount('http://', transport)
+        return session
+
+    def _start_request_deadline(self):
+        g._github_deadline = _now() + self.request_deadline
+
+    def _get_local_stack(self, name):
+        """Returns the thread local list ``name``."""
+        try:
+            return getattr(self._local, name)
+        except AttributeError:
+            stack = []
+            setattr(self._local, name, stack)
+            return stack
+
+    def deadline(self, seconds):
+        """
+        Limits the total time spent in requests to GitHub. Can be used as a
+        context manager or a decorator. Every request made inside it gets a
+        timeout no longer than the time left, and once the time is up
+        requests raise :class:`GitHubDeadlineExceeded` without being sent.
+        Nested deadlines can only shorten the outer one.
+
+        The ``GITHUB_REQUEST_DEADLINE`` setting applies a deadline to every
+        Flask request.
+
+        .. code-block:: python
+
+            @app.route('/dashboard')
+            @github.deadline(2.5)
+            def dashboard():
+                ...
+
+        The deadline belongs to the thread that entered it; requests made
+        from other threads (:meth:`bulk`, for example) are not limited.
+
+        """
+        return _Deadline(self, seconds)
+
+    def time_left(self):
+        """Returns the seconds left until the current deadline or ``None``
+        if there is no deadline."""
+        deadlines = self._get_local_stack('deadlines')[-1:]
+        if has_app_context() and '_github_deadline' in g:
+            deadlines.append(g._github_deadline)
+        if not deadlines:
+            return None
+        return min(deadlines) - _now()
+
+    def lane(self, name):
+        """
+        Sends the requests made inside it through the lane ``name`` of the
+        :class:`PriorityScheduler` enabled by ``GITHUB_PRIORITY_LANES``. Can
+        be used as a context manager or a decorator. Without it requests
+        made while handling a Flask request use the ``interactive`` lane and
+        others the ``background`` lane; :meth:`bulk` uses the ``bulk`` lane.
+
+        .. code-block:: python
+
+            @celery.task
+            @github.lane('bulk')
+            def sync_all_repositories():
+                ...
+
+        """
+        return _Lane(self, name)
+
+    def _get_lane(self):
+        lanes = self._get_local_stack('lanes')
+        if lanes:
+            return lanes[-1]
+        if has_request_context():
+            return 'interactive'
+        return 'background'
 
     def access_token_getter(self, f):
         """
@@ -200,7 +1508,7 @@ class GitHub(object):
         url = self.auth_url + 'access_token'
         _logger.debug("POSTing to %s", url)
         _logger.debug(params)
-        response = self.session.post(url, data=params)
+        response = self.session.post(url, data=params, timeout=self.timeout)
         data = parse_qs(response.content)
         _logger.debug("response.content = %s", data)
         for k, v in data.items():
@@ -223,7 +1531,143 @@ class GitHub(object):
         headers = self._pop_headers(kwargs)
         headers['Authorization'] = self._get_authorization_header(access_token)
         url = self._get_resource_url(resource)
-        return self.session.request(method, url, allow_redirects=True, headers=headers, **kwargs)
+        key = self._get_endpoint_key(url)
+        scheduler, lane = self.scheduler, None
+        if scheduler is not None:
+            lane = self._get_lane()
+            token = _hash_token(headers['Authorization'])
+            if not scheduler.acquire(lane, self.time_left(), token):
+                raise GitHubDeadlineExceeded()
+        response = None
+        try:
+            response = self._send(method, url, headers, key, **kwargs)
+        finally:
+            if lane is not None:
+                scheduler.release(lane, response, token)
+        return response
+
+    def _send(self, method, url, headers, key, **kwargs):
+        time_left = self.time_left()
+        if time_left is not None and time_left <= 0:
+            raise GitHubDeadlineExceeded()
+        breaker = self.circuit_breaker
+        if breaker is not None:
+            breaker.before_request(key)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._get_timeout(key)
+        if time_left is not None:
+            kwargs['timeout'] = _cap_timeout(kwargs['timeout'], time_left)
+        start = _now()
+        try:
+            if self.hedge_requests and method in ('GET', 'HEAD'):
+                response = self._hedged_request(key, method, url, allow_redirects=True, headers=headers, **kwargs)
+            else:
+                response = self.session.request(method, url, allow_redirects=True, headers=headers, **kwargs)
+        except Exception:
+            if breaker is not None:
+                breaker.record_failure(key)
+            raise
+        elapsed = _now() - start
+        self.latency.record(key, elapsed)
+        if breaker is not None:
+            if response.status_code >= 500:
+                breaker.record_failure(key)
+            else:
+                breaker.record_success(key, elapsed)
+        return response
+
+    def _hedged_request(self, key, method, url, **kwargs):
+        """Makes the request and, if no response arrived within the hedge
+        delay for ``key``, sends an identical second one. The first
+        successful response wins; the other one is closed."""
+        delay = self.latency.percentile(key, self.hedge_percentile)
+        if delay is None:
+            delay = self.hedge_delay
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {'done': False}
+
+        def send(hedge):
+            try:
+                outcome = (hedge, self.session.request(method, url, **kwargs),
+                           None)
+            except Exception as e:
+                outcome = (hedge, None, e)
+            with lock:
+                if state['done']:
+                    if outcome[1] is not None:
+                        outcome[1].close()
+                    return
+                results.put(outcome)
+
+        def start(hedge):
+            thread = threading.Thread(target=send, args=(hedge,))
+            thread.daemon = True
+            thread.start()
+
+        with self._hedge_lock:
+            self.hedge_stats['requests'] += 1
+        start(False)
+        pending = 1
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            with self._hedge_lock:
+                stats = self.hedge_stats
+                allowed = stats['hedged'] < \
+                    stats['requests'] * self.hedge_max_ratio
+                if allowed:
+                    stats['hedged'] += 1
+            if allowed:
+                _logger.debug("Hedging %s %s after %.3fs", method, url, delay)
+                start(True)
+                pending += 1
+            outcome = results.get()
+        pending -= 1
+        # A failed attempt only loses if the other one succeeds.
+        if outcome[2] is not None and pending:
+            other = results.get()
+            pending -= 1
+            if other[2] is None:
+                outcome = other
+        with lock:
+            state['done'] = True
+            while not results.empty():
+                late = results.get()
+                if late[1] is not None:
+                    late[1].close()
+        hedge, response, error = outcome
+        if error is not None:
+            raise error
+        if hedge:
+            with self._hedge_lock:
+                self.hedge_stats['hedge_wins'] += 1
+        return response
+
+    def _get_endpoint_key(self, url):
+        """Returns the endpoint class of ``url`` used for circuit breaking and
+        latency tracking: the host plus the first path segment."""
+        if url.startswith(self.base_url):
+            prefix, path = self.base_url, url[len(self.base_url):]
+        else:
+            parts = urlsplit(url)
+            prefix = '%s://%s/' % (parts.scheme, parts.netloc)
+            path = parts.path.lstrip('/')
+        return prefix + path.split('?', 1)[0].split('/', 1)[0]
+
+    def _get_timeout(self, key):
+        """Returns the timeout for a request to endpoint class ``key``.
+        With ``GITHUB_ADAPTIVE_TIMEOUT`` enabled it follows the observed p99
+        latency, bounded by ``GITHUB_MIN_TIMEOUT`` and ``GITHUB_TIMEOUT``."""
+        if not self.adaptive_timeout:
+            return self.timeout
+        p99 = self.latency.percentile(key, 99)
+        if p99 is None:
+            return self.timeout
+        timeout = max(p99 * 3, self.min_timeout)
+        if self.timeout is not None:
+            timeout = min(timeout, self.timeout)
+        return timeout
 
     def _pop_headers(self, kwargs):
         try:
@@ -247,7 +1691,36 @@ class GitHub(object):
         else:
             return self.base_url + resource
 
-    def request(self, method, resource, all_pages=False, **kwargs):
+    def _get_git_object_key(self, url, kwargs):
+        """Returns the :class:`GitObjectCache` key for a GET of ``url`` or
+        ``None`` if it is not addressed by a git object SHA. Keys start with
+        a hash of the token, which is resolved into ``kwargs`` here."""
+        parts = urlsplit(url)
+        match = _GIT_OBJECT_PATH.search(parts.path)
+        if match is None:
+            return None
+        if kwargs.get('access_token') is None:
+            kwargs['access_token'] = self.get_access_token()
+        token = _hash_token(
+            self._get_authorization_header(kwargs['access_token']))
+        kind, sha = match.groups()
+        if kind == 'git/blobs':
+            key = token + '/blobs/' + sha
+        else:
+            key = token + '/' + parts.netloc + parts.path
+        params = kwargs.get('params')
+        if isinstance(params, dict):
+            params = urlencode(sorted(params.items()))
+        elif isinstance(params, (list, tuple)):
+            params = urlencode(sorted(params))
+        elif isinstance(params, bytes):
+            params = params.decode('utf-8')
+        query = '&'.join(q for q in (parts.query, params) if q)
+        headers = kwargs.get('headers') or {}
+        return '%s?%s#%s' % (key, query, headers.get('Accept', ''))
+
+    def request(self, method, resource, all_pages=False, model=None,
+                keep_raw=False, **kwargs):
         """
         Makes a request to the given endpoint.
         Keyword arguments are passed to the :meth:`~requests.request` method.
@@ -255,13 +1728,33 @@ class GitHub(object):
         automatically and a dictionary will be returned.
         Otherwise the :class:`~requests.Response` object is returned.
 
+        If a :class:`Model` subclass is given as ``model``, JSON results are
+        decoded into instances of it instead (a list of them for list
+        results, and the ``items`` of search results). ``keep_raw`` keeps
+        the original data reachable through :attr:`Model.raw`.
+
         """
+        cache = self.git_object_cache
+        cache_key = None
+        if cache is not None and method == 'GET' and not all_pages:
+            cache_key = self._get_git_object_key(
+                self._get_resource_url(resource), kwargs)
+            if cache_key is not None:
+                content = cache.get(cache_key)
+                if content is not None:
+                    result = json.loads(content)
+                    if model is not None:
+                        result = _decode_model(result, model, keep_raw)
+                    return result
+
         response = self.raw_request(method, resource, **kwargs)
 
         if not is_valid_response(response):
             raise GitHubError(response)
 
         if is_json_response(response):
+            if cache_key is not None:
+                cache.set(cache_key, response.content)
             result = response.json()
             while all_pages and response.links.get('next'):
                 url = response.links['next']['url']
@@ -276,10 +1769,257 @@ class GitHub(object):
                     result['items'] += body['items']
                 else:
                     raise GitHubError(response)
+            if model is not None:
+                result = _decode_model(result, model, keep_raw)
             return result
         else:
             return response
 
+    def bulk(self, operations, max_workers=4, interval=1.0, max_retries=3,
+             backoff=60.0, access_token=None):
+        """
+        Runs many write operations with bounded concurrency and pacing, and
+        returns a list of :class:`BulkResult` in the order of
+        ``operations``. Failed operations do not stop the others.
+
+        :param operations: Iterable of ``(method, resource)`` or
+                           ``(method, resource, data)`` tuples. ``data`` is
+                           JSON encoded like in :meth:`post`. Consumed
+                           lazily, so it may be a generator.
+        :param max_workers: Number of operations in flight at once.
+        :param interval: Minimum seconds between starting two operations.
+                         GitHub asks for about one second between content
+                         creating requests.
+        :param max_retries: How many times an operation rejected by the
+                            primary or secondary rate limit is retried.
+                            Rejected requests were not applied so retrying
+                            is safe.
+        :param backoff: Seconds to wait after a rejection without a
+                        ``Retry-After`` header, doubled on every retry.
+        :param access_token: Token to use instead of calling the
+                             :meth:`access_token_getter` once before the
+                             operations start, which allows running outside
+                             of a Flask request context.
+
+        .. code-block:: python
+
+            results = github.bulk(
+                ('POST', 'repos/o/r/statuses/%s' % sha, {'state': 'success'})
+                for sha in shas)
+            failed = [r for r in results if not r.ok]
+
+        """
+        if access_token is None:
+            # Worker threads have no request context to call the getter in.
+            access_token = self.get_access_token()
+        throttle = _Throttle(interval)
+
+        @self.lane('bulk')
+        def call(item):
+            operation = item[1]
+            if len(operation) > 2:
+                return _call_throttled(
+                    throttle, max_retries, backoff, self._request_json,
+                    operation[0], operation[1], operation[2],
+                    access_token=access_token)
+            return _call_throttled(
+                throttle, max_retries, backoff, self.request,
+                operation[0], operation[1], access_token=access_token)
+
+        results = {}
+        for (index, operation), result, error in _imap_unordered(
+                call, enumerate(operations), max_workers):
+            results[index] = BulkResult(operation, result, error)
+        return [results[i] for i in range(len(results))]
+
+    def fetch_files(self, repo, ref, patterns, max_workers=8,
+                    archive_threshold=100, access_token=None):
+        """
+        Fetches the contents of many files of a repository at once and
+        returns a dictionary mapping paths to bytes.
+
+        The recursive tree of ``ref`` is listed with a single request. Up to
+        ``archive_threshold`` matching files are then downloaded as raw
+        blobs from ``max_workers`` threads. Larger selections, or trees too
+        big to be listed completely, are read from one streamed tarball
+        instead. Both ways return regular files only; symbolic links and
+        submodules are skipped.
+
+        :param repo: Repository as ``'owner/name'``.
+        :param ref: Branch, tag or commit SHA.
+        :param patterns: A path or glob pattern, or a list of them, matched
+                         against full paths with :func:`fnmatch.fnmatchcase`
+                         (``*`` also matches ``/``).
+        :param access_token: Token to use instead of calling the
+                             :meth:`access_token_getter`.
+
+        .. code-block:: python
+
+            files = github.fetch_files('cenkalti/github-flask', 'master',
+                                       ['setup.py', 'docs/*.rst'])
+
+        """
+        if not isinstance(patterns, (list, tuple, set)):
+            patterns = [patterns]
+        if access_token is None:
+            # Worker threads have no request context to call the getter in.
+            access_token = self.get_access_token()
+
+        def match(path):
+            return any(fnmatchcase(path, pattern) for pattern in patterns)
+
+        tree = self.get('repos/%s/git/trees/%s' % (repo, ref),
+                        params={'recursive': 1}, access_token=access_token)
+        # Symbolic links are blobs too, the tarball has no content for them.
+        blobs = [entry for entry in tree['tree']
+                 if entry['type'] == 'blob' and entry.get('mode') != '120000'
+                 and match(entry['path'])]
+        if tree.get('truncated') or len(blobs) > archive_threshold:
+            return self._fetch_archive_files(repo, ref, match, access_token)
+
+        def fetch(entry):
+            response = self.raw_request(
+                'GET', 'repos/%s/git/blobs/%s' % (repo, entry['sha']),
+                headers={'Accept': 'application/vnd.github.raw'},
+                access_token=access_token)
+            if not is_valid_response(response):
+                raise GitHubError(response)
+            return response.content
+
+        files = {}
+        with closing(_imap_unordered(fetch, blobs, max_workers)) as results:
+            for entry, content, error in results:
+                if error is not None:
+                    # Closing the results keeps other blobs from being sent.
+                    raise error
+                files[entry['path']] = content
+        return files
+
+    def _fetch_archive_files(self, repo, ref, match, access_token):
+        response = self.raw_request('GET', 'repos/%s/tarball/%s' % (repo, ref),
+                                    stream=True, access_token=access_token)
+        try:
+            if not is_valid_response(response):
+                raise GitHubError(response)
+            files = {}
+            with tarfile.open(fileobj=response.raw, mode='r|gz') as archive:
+                for member in archive:
+                    # Paths are prefixed with a "owner-repo-sha/" directory.
+                    path = member.name.partition('/')[2]
+                    if member.isfile() and match(path):
+                        files[path] = archive.extractfile(member).read()
+            return files
+        finally:
+            response.close()
+
+    def search(self, kind, query, qualifier='created', start=None, end=None,
+               max_workers=4, interval=2.0, max_retries=3, backoff=60.0,
+               access_token=None):
+        """
+        Yields all results of a search, working around the limit of 1000
+        results per search query.
+
+        The query is split into disjoint ranges of ``qualifier`` until each
+        range matches at most 1000 results. Pages of the ranges are then
+        fetched from ``max_workers`` threads, starting searches at most every
+        ``interval`` seconds to stay within the search rate limit (30 per
+        minute for authenticated users) and retrying when rate limited.
+        Items are yielded as they arrive, in no particular order, and without
+        duplicates.
+
+        :param kind: The search endpoint, e.g. ``'issues'`` or
+                     ``'repositories'``.
+        :param query: The search query without the ``qualifier``.
+        :param qualifier: A date qualifier such as ``'created'`` or
+                          ``'updated'``, or a numeric one such as ``'size'``
+                          or ``'stars'``.
+        :param start: First value of the range to search, inclusive. Date
+                      qualifiers default to 2008-01-01.
+        :param end: Last value of the range to search, inclusive. Date
+                    qualifiers default to today.
+
+        A range that cannot be split further but still matches more than
+        1000 results is logged and truncated.
+
+        .. code-block:: python
+
+            for issue in github.search('issues', 'repo:o/r is:issue'):
+                ...
+
+        """
+        if start is None or end is None:
+            if qualifier not in _DATE_QUALIFIERS:
+                raise ValueError("start and end are required for %r" %
+                                 qualifier)
+            start = start or datetime.date(2008, 1, 1)
+            end = end or datetime.date.today()
+        if access_token is None:
+            # Worker threads have no request context to call the getter in.
+            access_token = self.get_access_token()
+        throttle = _Throttle(interval)
+        resource = 'search/' + kind
+        per_page = 100
+
+        def fetch(shard):
+            (low, high), page = shard
+            params = {
+                'q': '%s %s:%s..%s' % (query, qualifier, low, high),
+                'per_page': per_page,
+                'page': page,
+            }
+            return _call_throttled(throttle, max_retries, backoff, self.get,
+                                   resource, params=params,
+                                   access_token=access_token)
+
+        seen = set()
+
+        def new_items(body):
+            for item in body['items']:
+                key = item.get('id') or item.get('url')
+                if key not in seen:
+                    seen.add(key)
+                    yield item
+
+        pages = []
+        ranges = [(start, end)]
+        while ranges:
+            split = []
+            with closing(_imap_unordered(fetch, [(r, 1) for r in ranges],
+                                         max_workers)) as results:
+                for ((low, high), _), body, error in results:
+                    if error is not None:
+                        raise error
+                    total = body['total_count']
+                    if total > _SEARCH_RESULT_LIMIT and low != high:
+                        split.extend(_split_range(low, high))
+                        continue
+                    if total > _SEARCH_RESULT_LIMIT:
+                        _logger.warning("Search for %s %s:%s has %d "
+                                        "results, only %d can be fetched",
+                                        query, qualifier, low, total,
+                                        _SEARCH_RESULT_LIMIT)
+                        total = _SEARCH_RESULT_LIMIT
+                    last_page = (total + per_page - 1) // per_page
+                    pages.extend(((low, high), page)
+                                 for page in range(2, last_page + 1))
+                    for item in new_items(body):
+                        yield item
+            ranges = split
+
+        with closing(_imap_unordered(fetch, pages, max_workers)) as results:
+            for _, body, error in results:
+                if error is not None:
+                    raise error
+                for item in new_items(body):
+                    yield item
+
+    def _request_json(self, method, resource, data, **kwargs):
+        headers = dict(kwargs.pop('headers', None) or {})
+        headers.setdefault('Content-Type', 'application/json')
+        data = json.dumps(data)
+        return self.request(method, resource, headers=headers,
+                            data=data, **kwargs)
+
     def get(self, resource, params=None, **kwargs):
         """Shortcut for ``request('GET', resource)``."""
         return self.request('GET', resource, params=params, **kwargs)
@@ -288,28 +2028,16 @@ class GitHub(object):
         """Shortcut for ``request('POST', resource)``.
         Use this to make POST request since it will also encode ``data`` to
         'application/json' format."""
-        headers = dict(kwargs.pop('headers', {}))
-        headers.setdefault('Content-Type', 'application/json')
-        data = json.dumps(data)
-        return self.request('POST', resource, headers=headers,
-                            data=data, **kwargs)
+        return self._request_json('POST', resource, data, **kwargs)
 
     def head(self, resource, **kwargs):
         return self.request('HEAD', resource, **kwargs)
 
     def patch(self, resource, data=None, **kwargs):
-        headers = dict(kwargs.pop('headers', {}))
-        headers.setdefault('Content-Type', 'application/json')
-        data = json.dumps(data)
-        return self.request('PATCH', resource, headers=headers,
-                            data=data, **kwargs)
+        return self._request_json('PATCH', resource, data, **kwargs)
 
     def put(self, resource, data=None, **kwargs):
-        headers = dict(kwargs.pop('headers', {}))
-        headers.setdefault('Content-Type', 'application/json')
-        data = json.dumps(data)
-        return self.request('PUT', resource, headers=headers,
-                            data=data, **kwargs)
+        return self._request_json('PUT', resource, data, **kwargs)
 
     def delete(self, resource, **kwargs):
         return self.request('DELETE', resource, **kwargs)
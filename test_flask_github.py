@@ -1,11 +1,24 @@
+import io
+import json
 import logging
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 
 import requests
 from mock import patch, Mock
 
-from flask import Flask, request, redirect
-from flask_github import GitHub
+from flask import Flask, request, redirect, g
+import flask_github
+from flask_github import GitHub, GitHubCircuitOpenError, GitHubError, \
+    GitHubDeadlineExceeded, Outbox, PriorityScheduler, Repository, \
+    RecordingTransport, ReplayTransport
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +33,7 @@ class GitHubTestCase(unittest.TestCase):
             assert data['client_id'] == '123'
             assert data['client_secret'] == 'SEKRET'
             assert data['code'] == 'KODE'
+            assert kwargs['timeout'] == 10.0
             response = Mock()
             response.content = b'access_token=asdf&token_type=bearer'
             return response
@@ -64,6 +78,485 @@ class GitHubTestCase(unittest.TestCase):
         assert called_auth
         assert access_token == ['asdf'], access_token
 
+    @patch.object(requests.Session, 'request')
+    def test_circuit_breaker(self, request):
+        request.return_value = Mock(status_code=503)
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        app.config['GITHUB_CIRCUIT_FAILURE_THRESHOLD'] = 2
+        github = GitHub(app)
+
+        for _ in range(2):
+            github.raw_request('GET', 'user', access_token='T')
+        self.assertRaises(GitHubCircuitOpenError,
+                          github.raw_request, 'GET', 'user', access_token='T')
+        assert request.call_count == 2
+        assert request.call_args[1]['timeout'] == 10.0
+
+        # Other endpoint classes are not affected
+        github.raw_request('GET', 'repos/a/b', access_token='T')
+        assert request.call_count == 3
+
+    @patch('time.sleep')
+    @patch.object(requests.Session, 'request')
+    def test_bulk(self, request, sleep):
+        limited = Mock(status_code=403, headers={'Retry-After': '5'})
+        created = Mock(status_code=201,
+                       headers={'Content-Type': 'application/json'})
+        created.json.return_value = {'state': 'success'}
+        missing = Mock(status_code=404, headers={})
+        request.side_effect = [limited, created, missing]
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        github = GitHub(app)
+
+        results = github.bulk([('POST', 'repos/a/b/statuses/1', {'x': 1}),
+                               ('DELETE', 'repos/a/b/labels/bug')],
+                              max_workers=1, access_token='T')
+
+        assert results[0].ok and results[0].result == {'state': 'success'}
+        assert request.call_args_list[1][1]['data'] == '{"x": 1}'
+        assert isinstance(results[1].error, GitHubError)
+        assert any(call[0][0] >= 4 for call in sleep.call_args_list)
+
+        # The token getter is called in the request context, not in workers
+        request.side_effect = None
+        request.return_value = created
+        github.access_token_getter(lambda: g.token)
+        with app.test_request_context():
+            g.token = 'G'
+            results = github.bulk([('POST', 'x', {})] * 2)
+        assert all(result.ok for result in results)
+        assert request.call_args[1]['headers']['Authorization'] == 'token G'
+
+    @patch.object(requests.Session, 'request')
+    def test_model(self, request):
+        data = {'full_name': 'a/b', 'owner': {'login': 'a', 'id': 1},
+                'private': False, 'node_id': 'XYZ'}
+        response = Mock(status_code=200,
+                        headers={'Content-Type': 'application/json'})
+        response.json.return_value = data
+        request.return_value = response
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        github = GitHub(app)
+
+        repo = github.get('repos/a/b', model=Repository, keep_raw=True,
+                          access_token='T')
+        assert repo.full_name == 'a/b'
+        assert repo.owner.login == 'a'
+        assert repo.language is None
+        assert not hasattr(repo, '__dict__')
+        assert repo.raw == data
+
+    def test_lazy_import(self):
+        # Importing and initializing the extension must not import requests
+        code = '\n'.join([
+            'import sys',
+            'from flask import Flask',
+            'from flask_github import GitHub',
+            'app = Flask(__name__)',
+            'app.config["GITHUB_CLIENT_ID"] = "123"',
+            'app.config["GITHUB_CLIENT_SECRET"] = "SEKRET"',
+            'github = GitHub(app)',
+            'assert "requests" not in sys.modules',
+            'github.session',
+            'assert "requests" in sys.modules',
+        ])
+        subprocess.check_call([sys.executable, '-c', code])
+
+    def test_record_replay(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        cassette = os.path.join(tmp, 'cassette.jsonl')
+        url = 'https://api.github.com/user/repos'
+        with open(cassette, 'w') as f:
+            for record in [
+                {'method': 'GET', 'url': url, 'status': 200,
+                 'headers': {'Content-Type': 'application/json',
+                             'Link': '<%s?page=2>; rel="next"' % url},
+                 'text': '[1, 2]'},
+                {'method': 'GET', 'url': url + '?page=2', 'status': 200,
+                 'headers': {'Content-Type': 'application/json'},
+                 'text': '[3]'},
+            ]:
+                f.write(json.dumps(record) + '\n')
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        app.config['GITHUB_REPLAY_FROM'] = cassette
+        github = GitHub(app)
+
+        assert github.get('user/repos', all_pages=True,
+                          access_token='T') == [1, 2, 3]
+        self.assertRaises(requests.ConnectionError,
+                          github.get, 'user', access_token='T')
+
+        # Recording the replayed responses yields the same cassette
+        copy = os.path.join(tmp, 'copy.jsonl')
+        github.session.mount('https://', RecordingTransport(
+            copy, ReplayTransport(cassette)))
+        github.get('user/repos', all_pages=True, access_token='T')
+        with open(cassette) as f, open(copy) as g:
+            for a, b in zip(f, g):
+                a, b = json.loads(a), json.loads(b)
+                assert (a['url'], a['headers'], a['text']) == \
+                    (b['url'], b['headers'], b['text'])
+
+    @patch.object(requests.Session, 'request')
+    def test_git_object_cache(self, request):
+        def respond(method, url, **kwargs):
+            response = Mock(status_code=200,
+                            headers={'Content-Type': 'application/json'})
+            response.content = json.dumps({'url': url}).encode('ascii')
+            response.json.return_value = json.loads(response.content)
+            return response
+        request.side_effect = respond
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        app.config['GITHUB_GIT_OBJECT_CACHE_SIZE'] = 1024
+        app.config['GITHUB_GIT_OBJECT_CACHE_DIR'] = tmp
+        github = GitHub(app)
+
+        sha = 'a' * 40
+        blob = github.get('repos/a/b/git/blobs/' + sha, access_token='T')
+        # Same blob in another repository is served from the cache
+        assert github.get('/repos/c/d/git/blobs/' + sha,
+                          access_token='T') == blob
+        github.get('repos/a/b/git/trees/' + sha, params={'recursive': 1},
+                   access_token='T')
+        github.get('repos/a/b/git/trees/' + sha, params=[('recursive', 1)],
+                   access_token='T')
+        github.get('repos/a/b/git/trees/' + sha, params=b'recursive=1',
+                   access_token='T')
+        # Branch names are not immutable
+        github.get('repos/a/b/commits/master', access_token='T')
+        github.get('repos/a/b/commits/master', access_token='T')
+        assert request.call_count == 4
+
+        # Entries survive in the cache directory
+        github = GitHub(app)
+        github.get('repos/a/b/git/blobs/' + sha, access_token='T')
+        assert request.call_count == 4
+
+        # Other tokens do not see cached entries
+        github.get('repos/a/b/git/blobs/' + sha, access_token='U')
+        assert request.call_count == 5
+
+    @patch.object(requests.Session, 'request')
+    def test_hedged_request(self, request):
+        slow, fast = Mock(status_code=200), Mock(status_code=200)
+        calls = []
+
+        def respond(method, url, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return slow
+            return fast
+        request.side_effect = respond
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        app.config['GITHUB_HEDGE_REQUESTS'] = True
+        app.config['GITHUB_HEDGE_DELAY'] = 0.01
+        app.config['GITHUB_HEDGE_MAX_RATIO'] = 1
+        github = GitHub(app)
+
+        assert github.raw_request('GET', 'user', access_token='T') is fast
+        assert github.hedge_stats == {'requests': 1, 'hedged': 1,
+                                      'hedge_wins': 1}
+        # Writes are never hedged
+        calls[:] = []
+        github.raw_request('POST', 'user', access_token='T')
+        assert len(calls) == 1
+
+    @patch.object(requests.Session, 'request')
+    def test_deadline(self, request):
+        request.return_value = Mock(status_code=200)
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        app.config['GITHUB_REQUEST_DEADLINE'] = 5
+        github = GitHub(app)
+
+        @app.route('/view')
+        @github.deadline(60)
+        def view():
+            github.raw_request('GET', 'user', access_token='T')
+            assert request.call_args[1]['timeout'] <= 5
+            with github.deadline(0):
+                self.assertRaises(GitHubDeadlineExceeded, github.raw_request,
+                                  'GET', 'user', access_token='T')
+            return ''
+
+        assert app.test_client().get('/view').status_code == 200
+        assert request.call_count == 1
+        assert github.time_left() is None
+
+    @patch.object(requests.Session, 'request')
+    def test_fetch_files(self, request):
+        tree = Mock(status_code=200,
+                    headers={'Content-Type': 'application/json'})
+        tree.json.return_value = {'truncated': False, 'tree': [
+            {'path': 'setup.py', 'type': 'blob', 'sha': '1'},
+            {'path': 'docs', 'type': 'tree', 'sha': '2'},
+            {'path': 'docs/index.rst', 'type': 'blob', 'sha': '3'},
+            {'path': 'README.rst', 'type': 'blob', 'sha': '4'},
+            {'path': 'link.py', 'type': 'blob', 'mode': '120000',
+             'sha': '5'},
+        ]}
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for path in ['setup.py', 'docs/index.rst', 'README.rst']:
+                content = path.encode('ascii')
+                info = tarfile.TarInfo('o-r-abc/' + path)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            info = tarfile.TarInfo('o-r-abc/link.py')
+            info.type = tarfile.SYMTYPE
+            info.linkname = 'setup.py'
+            tar.addfile(info)
+        tarball = Mock(status_code=200, headers={},
+                       raw=io.BytesIO(archive.getvalue()))
+
+        def respond(method, url, **kwargs):
+            if '/git/trees/' in url:
+                return tree
+            if '/tarball/' in url:
+                return tarball
+            assert kwargs['headers']['Accept'] == 'application/vnd.github.raw'
+            return Mock(status_code=200, content=url[-1].encode('ascii'))
+        request.side_effect = respond
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        github = GitHub(app)
+
+        github.access_token_getter(lambda: g.token)
+        with app.test_request_context():
+            g.token = 'T'
+            files = github.fetch_files('o/r', 'master', ['*.py', 'docs/*'])
+        assert files == {'setup.py': b'1', 'docs/index.rst': b'3'}
+
+        # Symbolic links are skipped by both strategies
+        files = github.fetch_files('o/r', 'master', ['*.rst', 'link.py'],
+                                   archive_threshold=1, access_token='T')
+        assert files == {'docs/index.rst': b'docs/index.rst',
+                         'README.rst': b'README.rst'}
+
+    @patch.object(requests.Session, 'request')
+    def test_outbox(self, request):
+        created = Mock(status_code=201, headers={})
+        request.side_effect = [Mock(status_code=403,
+                                    headers={'Retry-After': '0'}),
+                               created, created, created,
+                               Mock(status_code=502, headers={})]
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        github = GitHub(app)
+        outbox = Outbox(github, os.path.join(tmp, 'outbox.db'), backoff=0)
+
+        outbox.post('repos/a/b/issues/1/comments', {'body': 'one'},
+                    key='one', access_token='T')
+        outbox.post('repos/a/b/issues/1/comments', {'body': 'two'},
+                    access_token='T')
+        outbox.post('repos/a/b/issues/1/comments', {'body': 'one'},
+                    key='one', access_token='T')
+        outbox.delete('repos/a/b/issues/2/labels/bug', access_token='T')
+        assert outbox.pending() == 3
+        assert request.call_count == 0
+
+        # The first comment is rate limited and holds back the second one
+        assert outbox.drain() == 1
+        assert outbox.drain() == 2
+        assert outbox.pending() == 0
+        bodies = [call[1].get('data') for call in request.call_args_list]
+        assert bodies == ['{"body": "one"}', None, '{"body": "one"}',
+                          '{"body": "two"}']
+        assert outbox.status('one') == ('done', None)
+
+        # Requests claimed by another drainer are not sent again
+        other = Outbox(github, os.path.join(tmp, 'outbox.db'))
+        outbox.post('repos/a/b/issues/3/comments', {'body': 'three'},
+                    key='three', access_token='T')
+        assert len(other._claim(10, 'other')) == 1
+        assert outbox.drain() == 0
+        assert request.call_count == 4
+
+        # Stale claims are taken over. A 502 may come after the comment was
+        # created, so it is not retried.
+        outbox.claim_timeout = -1
+        assert outbox.drain() == 1
+        assert outbox.status('three')[0] == 'failed'
+
+        # Finished requests forget their token and can be purged
+        with outbox._connect() as db:
+            assert db.execute('SELECT COUNT(*) FROM outbox WHERE '
+                              'access_token IS NOT NULL').fetchone()[0] == 0
+        assert outbox.purge(3600) == 0
+        assert outbox.purge(-1) == 4
+        assert outbox.status('one') is None
+
+    @patch.object(requests.Session, 'request')
+    def test_outbox_claim_takeover(self, request):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        github = GitHub(app)
+        path = os.path.join(tmp, 'outbox.db')
+        outbox = Outbox(github, path)
+        other = Outbox(github, path, claim_timeout=0.2)
+
+        def respond(method, url, **kwargs):
+            if len(request.call_args_list) == 1:
+                time.sleep(0.3)
+            elif len(request.call_args_list) == 2:
+                # Another drainer takes over the claims of requests that
+                # were not sent yet while the second one is in flight.
+                assert other.drain() == 1
+            return Mock(status_code=201, headers={})
+        request.side_effect = respond
+
+        for number in range(3):
+            outbox.post('repos/a/b/issues/%d/comments' % number, {},
+                        key=str(number), access_token='T')
+        assert outbox.drain() == 2
+        assert request.call_count == 3
+        assert [outbox.status(str(n))[0] for n in range(3)] == ['done'] * 3
+
+    @patch.object(requests.Session, 'request')
+    def test_search(self, request):
+        repos = [{'id': i, 'size': i % 40} for i in range(2500)]
+        queries = []
+
+        def respond(method, url, params, **kwargs):
+            queries.append(params['q'])
+            low, high = params['q'].split('size:')[1].split('..')
+            found = [r for r in repos if int(low) <= r['size'] <= int(high)]
+            page, per_page = params['page'], params['per_page']
+            response = Mock(status_code=200,
+                            headers={'Content-Type': 'application/json'})
+            response.json.return_value = {
+                'total_count': len(found),
+                'items': found[(page - 1) * per_page:page * per_page]}
+            return response
+        request.side_effect = respond
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        github = GitHub(app)
+
+        github.access_token_getter(lambda: g.token)
+        with app.test_request_context():
+            g.token = 'T'
+            items = list(github.search('repositories', 'language:python',
+                                       'size', 0, 39, interval=0))
+        assert sorted(item['id'] for item in items) == list(range(2500))
+        assert queries[0] == 'language:python size:0..39'
+        self.assertRaises(ValueError, next,
+                          github.search('repositories', 'x', 'size',
+                                        access_token='T'))
+
+        # Closing the generator stops the workers
+        calls = []
+
+        def fetch(item):
+            calls.append(item)
+            time.sleep(0.01)
+            return item
+        results = flask_github._imap_unordered(fetch, range(100), 2)
+        next(results)
+        results.close()
+        time.sleep(0.2)
+        assert len(calls) <= 5, calls
+
+    def test_priority_scheduler(self):
+        scheduler = PriorityScheduler({
+            'interactive': {'priority': 0, 'concurrency': 1, 'quota': 1.0},
+            'background': {'priority': 1, 'concurrency': 1, 'quota': 0.5},
+        }, max_concurrency=1)
+        order = []
+
+        def run(lane):
+            scheduler.acquire(lane)
+            order.append(lane)
+            scheduler.release(lane)
+
+        assert scheduler.acquire('background')
+        threads = [threading.Thread(target=run, args=(lane,))
+                   for lane in ('background', 'interactive')]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.05)
+        stats = scheduler.stats()
+        assert stats['background']['queued'] == 1
+        assert stats['interactive']['queued'] == 1
+        scheduler.release('background')
+        for thread in threads:
+            thread.join()
+        # Interactive work jumps ahead of queued background work
+        assert order == ['interactive', 'background']
+
+        # Background may not use more than half of a token's rate limit
+        assert scheduler.acquire('interactive', token='A')
+        scheduler.release('interactive', Mock(headers={
+            'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '40',
+            'X-RateLimit-Reset': str(time.time() + 60)}), token='A')
+        assert not scheduler.acquire('background', timeout=0.01, token='A')
+        assert scheduler.acquire('background', timeout=0.01, token='B')
+        scheduler.release('background', token='B')
+
+        # An exhausted rate limit does not hold back interactive requests
+        assert scheduler.acquire('interactive', token='A')
+        scheduler.release('interactive', Mock(headers={
+            'X-RateLimit-Limit': '100', 'X-RateLimit-Remaining': '0',
+            'X-RateLimit-Reset': str(time.time() + 3600)}), token='A')
+        start = time.time()
+        assert scheduler.acquire('interactive', token='A')
+        assert time.time() - start < 0.5
+
+        self.assertRaises(ValueError, PriorityScheduler,
+                          {'reports': {'concurrency': 2}})
+
+    @patch.object(requests.Session, 'request')
+    def test_priority_lanes_config(self, request):
+        request.return_value = Mock(status_code=200, headers={})
+
+        app = Flask(__name__)
+        app.config['GITHUB_CLIENT_ID'] = '123'
+        app.config['GITHUB_CLIENT_SECRET'] = 'SEKRET'
+        app.config['GITHUB_PRIORITY_LANES'] = {'reports': {'concurrency': 2}}
+        github = GitHub(app)
+
+        with github.lane('reports'):
+            github.raw_request('GET', 'user', access_token='T')
+        lanes = github.scheduler.lanes
+        assert lanes['reports']['concurrency'] == 2
+        assert lanes['reports']['priority'] == lanes['background']['priority']
+        assert github.scheduler.stats()['reports']['requests'] == 1
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)